@@ -1,10 +1,18 @@
 import os 
-import copy
+import io
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np 
+import pandas as pd
+import numexpr as ne
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import scipy.stats as stats
 
+# Lines in Gen5 exports that start a new read block, either by their prefix or by their length (including the newline).
+_READ_HEADERS = ('Read', 'GFP', 'RFP', '600', 'Ratio')
+_READ_HEADER_LENGTHS = (4, 8)
+
 def Organize(data_file:str, n_rows:int, n_columns:int, total_run_time:float, sampling_rate:float, debug = False)->dict:
     '''
     Creates a 3D array where the first dimension is represents the plate rows, the second represents the plate columns, and the third contains the timeseries data.
@@ -19,59 +27,111 @@ def Organize(data_file:str, n_rows:int, n_columns:int, total_run_time:float, sam
         -total_run_time(float): Total reader run time in hours.
         -sampling_rate(float): Sampling rate in hours.
     Returns:
-        -data_dict(dict): Keys are the read titles and values are the 3D data arrays.
-        -time_dict(dict): Keys are the read titles and values are 1D arrays of the timepoints in hours.
+        -data_dict(dict): Keys are the read titles and values are the 3D float32 data arrays.
+        -time_dict(dict): Keys are the read titles and values are 1D float32 arrays of the timepoints in hours.
     '''
-    data_read = open(data_file, encoding='iso-8859-1')
-
     n_time_points = int(total_run_time/sampling_rate)
+    n_wells = n_rows*n_columns
 
-    data_dict = {}
-    time_dict = {}
-
-    for i, line in enumerate(data_read):
-        if debug: #debug:
-            print(i, line, len(line))
-        if  line[0:4] == 'Read' or line[0:3] == 'GFP' or line[0:3] == 'RFP' or line[0:3] == '600' or line[0:5] == 'Ratio' or len(line) == 4 or len(line) == 8:
-            time_i = -1
-            read = str(line)[:-1]
+    blocks = {} # Keys are the read titles and values are lists of [start, stop] byte offsets of runs of adjacent data lines.
 
-            data_dict[read] = np.zeros((n_rows, n_columns, n_time_points+1))
-            time_dict[read] = np.zeros(n_time_points+1)
-            data_dict[read][:] = np.nan
-            time_dict[read][:] = np.nan
-        
-        elif  line != '\n' and 'Time' not in line:
-            element = line.strip().split('\t') # Remove \n from lines and convert to strings.
-            if debug:
-                print('element, length element:', element, len(element))
+    # Empty files cannot be memory mapped and contain no reads.
+    if os.path.getsize(data_file) == 0:
+        return({}, {})
 
-            time_i += 1
+    # Map the file so both passes read straight from the page cache instead of copying through Python's file buffers.
+    with open(data_file, 'rb') as data_read, mmap.mmap(data_read.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # First pass: locate the block of data lines belonging to each read.
+        stop = 0
+        for i, raw in enumerate(iter(mm.readline, b'')):
+            start, stop = stop, stop+len(raw)
+            line = raw.replace(b'\r\n', b'\n').decode('iso-8859-1')
+            if debug: #debug:
+                print(i, line, len(line))
+            if line.startswith(_READ_HEADERS) or len(line) in _READ_HEADER_LENGTHS:
+                read = str(line)[:-1]
+                blocks[read] = []
             
-            time_split = str(element[0]).split(':') # Covert time to string and seperate into hr, min, sec.
+            elif  line != '\n' and 'Time' not in line:
+                runs = blocks[read]
+                if runs and runs[-1][1] == start:
+                    runs[-1][1] = stop
+                else:
+                    runs.append([start, stop])
 
-            s = float(time_split[2])
-            m = float(time_split[1])+(s/60)
-            h = float(time_split[0])+(m/60)
-            
-            time_dict[read][time_i] = h
+        # Allocate one contiguous buffer for all reads and hand out per read views. The data is time-major so that
+        # each timepoint is a contiguous (rows, columns) slab.
+        # float32 holds the ~4 significant digits of the reader and halves the memory traffic of downstream reductions.
+        all_data = np.full((len(blocks), n_time_points+1, n_rows, n_columns), np.nan, dtype=np.float32)
+        all_time = np.full((len(blocks), n_time_points+1), np.nan, dtype=np.float32)
+        data_dict = {read: all_data[k] for k, read in enumerate(blocks)}
+        time_dict = {read: all_time[k] for k, read in enumerate(blocks)}
 
-                
-            for row_i in range(n_rows):
-                for column_i in range(n_columns):
-                    if debug:
-                        print('i,j,element_i:', row_i, column_i, n_columns*row_i+1+1+column_i)
-                    if len(element) == 1:
-                        data_dict[read][row_i, column_i, time_i] = np.nan
-                    if element[n_columns*row_i+1+1+column_i] == 'OVRFLW':
-                        data_dict[read][row_i, column_i, time_i] = np.nan
-                    else:   
-                        data_dict[read][row_i, column_i, time_i] = element[n_columns*row_i+1+1+column_i]
+        # Second pass: parse each block in bulk with pandas' C parser. Columns are time, temperature, then the wells.
+        # Overflowed wells and short lines are stored as nan.
+        for read, runs in blocks.items():
+            if not runs:
+                continue
+            # Only the recorded data lines are parsed, any blank or 'Time' lines between them are left out.
+            block = pd.read_csv(io.BytesIO(b''.join([mm[start:stop] for start, stop in runs])), sep='\t', header=None,
+                                names=range(2+n_wells), usecols=range(2+n_wells), na_values=['OVRFLW'],
+                                encoding='iso-8859-1', engine='c')
+            n_lines = len(block)
             if debug:
-                print(data_dict[read])
+                print('read, block:', read, block)
+
+            time_dict[read][:n_lines] = pd.to_timedelta(block[0]).dt.total_seconds().to_numpy()/3600 # HH:MM:SS to hours.
+
+            data = block.iloc[:, 2:].to_numpy(dtype=np.float32)
+            data_dict[read][:n_lines] = data.reshape(n_lines, n_rows, n_columns)
+
+    # Return (rows, columns, time) views of the time-major buffers.
+    data_dict = {read: data.transpose(1, 2, 0) for read, data in data_dict.items()}
 
     return(data_dict, time_dict)
 
+def _map_groups(func, group_args:list)->list:
+    """
+    Calls func once per experimental group. The groups are independent and the NumPy reductions release the GIL, so
+    several groups are run in a thread pool. numexpr is already multithreaded, so the pool is capped at the core count
+    and skipped entirely for a single group.
+
+    Args:
+        func (function): The per group function, e.g. _blank_group.
+        group_args (list): A list of argument tuples, one per group.
+
+    Returns:
+        list: The results of func in the order of group_args.
+    """
+    if len(group_args) <= 1:
+        return [func(*args) for args in group_args]
+    with ThreadPoolExecutor(max_workers=min(len(group_args), os.cpu_count() or 1)) as executor:
+        return list(executor.map(func, *zip(*group_args)))
+
+def _blank_group(g:dict, b:dict, reads:list, err_reads:list)->dict:
+    """
+    Blanks the data of a single experimental group, see blank.
+
+    Args:
+        g (dict): The read data for the experimental group.
+        b (dict): The read data for the blank group.
+        reads (list): A list of strings which designates the reads of interest.
+        err_reads (list): The error keys corresponding to reads.
+
+    Returns:
+        dict: The blanked data for each read and the error.
+    """
+    group_data = {}
+    for read, read_err in zip(reads, err_reads):
+        g_read = g[read]
+        b_read = b[read]
+        # Standard error of the replicate mean and of the blank, combined in quadrature.
+        g_var = g_read.var(axis=1)/g_read.shape[1]
+        b_var = b_read.var(axis=0)/b_read.shape[0]
+        group_data.update({read: g_read.mean(axis=1)-b_read})
+        group_data.update({read_err: ne.evaluate('sqrt(g_var+b_var)')})
+    return group_data
+
 def blank(group_names:list, groups:list, blanks:list, reads:list)->dict:
     """
     Blanks the data in goups by suptracting the data in blanks for everytime point.
@@ -85,15 +145,43 @@ def blank(group_names:list, groups:list, blanks:list, reads:list)->dict:
     Returns:
         dict: The keys are a strings designating the group type and the values are dictionaries containing the blanked data for each read and the error.
     """
-    blank_data = {}
-    for i, name in enumerate(group_names):
-        blank_data[name] = {}
-        g = groups[i]
-        b = blanks[i]
-        for read in reads:
-            blank_data[name].update({read: g[read].mean(axis=1)-b[read]})
-            blank_data[name].update({read+'_err': np.sqrt(np.square(g[read].std(axis=1))/g[read].shape[1]+np.square(b[read].std(axis=0))/b[read].shape[0])})                                  
-    return blank_data 
+    err_reads = [read+'_err' for read in reads]
+    results = _map_groups(_blank_group, [(groups[i], blanks[i], reads, err_reads) for i in range(len(group_names))])
+    return dict(zip(group_names, results))
+
+def _normalize_group(g:dict, fl_reads:list, fl_err_reads:list, off_set:float)->dict:
+    """
+    Normalizes the data of a single experimental group, see normalize.
+
+    Args:
+        g (dict): The read data and errors for the experimental group.
+        fl_reads (list): The reads to normalize, excluding the OD600 read.
+        fl_err_reads (list): The error keys corresponding to fl_reads.
+        off_set (float): The offest in the denomenator of the equation y = read/(off_set+OD600).
+
+    Returns:
+        dict: The normalized data for each read as well as the error.
+    """
+    group_data = {}
+    od = g['600']
+    od_err = g['600_err']
+    if not fl_reads:
+        return {'600': od, '600_err': od_err}
+
+    # Stack the reads so that every read is normalized by the same cached denominator in one operation.
+    data = np.stack([g[read] for read in fl_reads])
+    data_err = np.stack([g[read_err] for read_err in fl_err_reads])
+    denom = off_set+od
+    norm = data/denom
+    # Equivalent to |norm|*sqrt((data_err/data)^2+(OD600_err/denom)^2) without dividing by reads that may be zero.
+    # denom can be negative after blanking, so divide by its magnitude.
+    norm_err = ne.evaluate('sqrt(data_err**2+(norm*od_err)**2)/abs(denom)')
+
+    group_data.update(zip(fl_reads, norm))
+    group_data.update({'600': od})
+    group_data.update(zip(fl_err_reads, norm_err))
+    group_data['600_err'] = od_err
+    return group_data
 
 def normalize(group_names:list, groups:list, reads:list, off_set=0.1)->dict:
     """
@@ -108,16 +196,13 @@ def normalize(group_names:list, groups:list, reads:list, off_set=0.1)->dict:
     Returns:
         dict: The keys are a strings designating the group type and the values are dictionaries containing the normalize data for each read as well as the error.
     """
-    norm_data = {}
-    for i, name in enumerate(group_names):
-        norm_data[name] = {}
-        g = groups[i]
-        if '_err' not in name:
-            norm_data[name].update({read: g[read]/(off_set+g['600']) for read in reads if read != '600'})
-            norm_data[name].update({'600': g['600']})
-            norm_data[name].update({read+'_err': norm_data[name][read]*np.sqrt(np.square(g[read+'_err']/(off_set+g[read]))+np.square(g['600_err']/(off_set+g['600']))) for read in reads if read != '600'})
-            norm_data[name]['600_err'] = g['600_err']
-    return norm_data
+    fl_reads = [read for read in reads if read != '600']
+    fl_err_reads = [read+'_err' for read in fl_reads]
+    norm_names = [name for name in group_names if '_err' not in name]
+    results = _map_groups(_normalize_group, [(groups[i], fl_reads, fl_err_reads, off_set)
+                                             for i, name in enumerate(group_names) if '_err' not in name])
+    norm_data = dict(zip(norm_names, results))
+    return {name: norm_data.get(name, {}) for name in group_names}
 
 def well_curves(data:dict, time:dict, read:str, size=(20, 15), s=10)->None:
     """
@@ -130,11 +215,24 @@ def well_curves(data:dict, time:dict, read:str, size=(20, 15), s=10)->None:
         size (tuple, optional): Matlab figure size. Defaults to (20, 15).
         s (int, optional): Scatter plot marker size. Defaults to 10.
     """
-    fig, axs = plt.subplots(data[read].shape[0], data[read].shape[1], figsize=size, sharey=True, sharex=True)
+    t = time[read]
+    d = data[read]
+    fig, axs = plt.subplots(d.shape[0], d.shape[1], figsize=size, sharey=True, sharex=True)
     
-    for i in range(data[read].shape[0]):
-        for j in range(data[read].shape[1]):
-            axs[i,j].scatter(time[read],data[read][i,j,:],s=s)
+    # plot with markers only is much cheaper than scatter for a uniform marker, markersize is the sqrt of the scatter area.
+    for i in range(d.shape[0]):
+        for j in range(d.shape[1]):
+            axs[i,j].plot(t, d[i,j,:], marker='o', linestyle='none', markersize=np.sqrt(s))
+    
+    # The axes are shared so the limits only need to be set once instead of autoscaling every subplot.
+    # Empty (all nan) or constant data is left to autoscaling.
+    for set_lim, values in ((axs[0,0].set_xlim, t), (axs[0,0].set_ylim, d)):
+        finite = values[np.isfinite(values)]
+        if finite.size:
+            v_min, v_max = finite.min(), finite.max()
+            if v_max > v_min:
+                v_pad = 0.05*(v_max-v_min)
+                set_lim(v_min-v_pad, v_max+v_pad)
             
     fig.suptitle(read, size=24)
     fig.supxlabel('Time [Hr.]', size=24)
@@ -169,7 +267,7 @@ def pretty_plot(groups:list, time:dict, reads:list, titles:list, err='fill', spi
         colors (_type_, optional): _description_. Defaults to None.
     """
     
-    reads = copy.deepcopy(reads)
+    reads = list(reads)
     legend = []
     p = []
     f = []
@@ -181,30 +279,50 @@ def pretty_plot(groups:list, time:dict, reads:list, titles:list, err='fill', spi
     if not OD600:
         reads.remove('600')
         
+    prop_colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        
     for i, group in enumerate(groups):
         for j, read in enumerate(reads):
-            for k in range(group[read].shape[0]):
-                if colors == None:
-                    c = None
-                else:
-                    c = colors[k]
-                if err == 'fill':
-                    p_element = axs[j,i].scatter(time[read], group[read][k,:], alpha=a, s=face_size, color=c)
-                    p.append(p_element)
-                    
-                    color = p_element.get_facecolor()
-                    
-                    f_element = axs[j,i].fill_between(time[read], group[read][k,:]-group[read+'_err'][k,:], 
-                                                      group[read][k,:]+group[read+'_err'][k,:], 
-                                                      color=color,alpha=a*fcorr)
-                    f.append(f_element)
-                if err == 'bar':
-                    axs[j,i].errorbar(time[read], group[read][k,:],
-                                        group[read+'_err'][k,:], errorevery=20, capsize=csize)
+            ax = axs[j,i]
+            t = time[read]
+            y = group[read]
+            y_err = group[read+'_err']
+            n_rep, n_time = y.shape
+            if colors == None:
+                rep_colors = [prop_colors[k % len(prop_colors)] for k in range(n_rep)]
+            else:
+                rep_colors = colors[:n_rep]
+                
+            if err == 'fill':
+                # Draw every replicate with a single scatter call, colored per replicate.
+                ax.scatter(np.tile(t, n_rep), y.ravel(), alpha=a, s=face_size,
+                           color=np.repeat(mpl.colors.to_rgba_array(rep_colors), n_time, axis=0))
+                # Draw the error envelopes of every replicate as a single PolyCollection instead of a fill_between each.
+                # As with fill_between, each run of finite points gets its own polygon so nan values leave a gap.
+                lower = y-y_err
+                upper = y+y_err
+                finite = np.isfinite(t) & np.isfinite(lower) & np.isfinite(upper)
+                verts = []
+                poly_colors = []
+                for k in range(n_rep):
+                    edges = np.flatnonzero(np.diff(np.r_[0, finite[k], 0]))
+                    for start, stop in zip(edges[::2], edges[1::2]):
+                        t_run = t[start:stop]
+                        verts.append(np.column_stack([np.r_[t_run, t_run[::-1]],
+                                                      np.r_[lower[k, start:stop], upper[k, start:stop][::-1]]]))
+                        poly_colors.append(rep_colors[k])
+                ax.add_collection(mpl.collections.PolyCollection(verts, color=poly_colors, alpha=a*fcorr))
+                if not p:
+                    # Legend proxies for the replicates, since the markers no longer have an artist each.
+                    p = [mpl.lines.Line2D([], [], marker='o', linestyle='none', markersize=np.sqrt(face_size), color=c, alpha=a) for c in rep_colors]
+                    f = [mpl.patches.Patch(color=c, alpha=a*fcorr) for c in rep_colors]
+            if err == 'bar':
+                for k in range(n_rep):
+                    ax.errorbar(t, y[k,:], y_err[k,:], errorevery=20, capsize=csize)
                     
-                if not spines:
-                    axs[j,i].spines['right'].set_visible(False)
-                    axs[j,i].spines['top'].set_visible(False)
+            if not spines:
+                ax.spines['right'].set_visible(False)
+                ax.spines['top'].set_visible(False)
                     
             axs[0,i].set_title(titles[i], fontsize=fsize, loc='left')
             